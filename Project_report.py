@@ -1,10 +1,20 @@
 import sys
+import os
+import time
+import tempfile
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from pathlib import Path
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from datetime import datetime
 import io
+import hashlib
 import calendar
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # Assuming your current script is in a directory and the helper modules are in a sibling directory
 parent_dir = Path(__file__).resolve().parent.parent
@@ -36,6 +46,15 @@ PROJECT_NAME_MAPPING = {
     'Text Vegas': 'Text Vegas',
 }
 
+# Mapping table with one row per BigQuery project behind each CSV column
+# (combined columns like Vars/Vita. expand to one row per alias)
+PROJECT_MAPPING_DF = pd.DataFrame(
+    [(project_col, project)
+     for project_col, mapped in PROJECT_NAME_MAPPING.items()
+     for project in (mapped if isinstance(mapped, list) else [mapped])],
+    columns=['ProjectCol', 'standardized_project']
+)
+
 # Month name mapping to handle abbreviations
 MONTH_MAPPING = {
     'Jan': 'January',
@@ -55,57 +74,117 @@ MONTH_MAPPING = {
 # Columns to ignore in the CSV
 IGNORED_COLUMNS = ['Dept', 'Level', 'Internal Alc.', 'Avail. Bandwidth', 'Project Alc.']
 
+# Directory for the on-disk cache of BigQuery results
+CACHE_DIR = Path(__file__).resolve().parent / ".cache"
+
+# On-disk copies older than this are refreshed, matching the st.cache_data ttl
+CACHE_TTL_SECONDS = 3600
+
+# Full month name to month number (1-12)
+_MONTH_TO_NUM = {name: i for i, name in enumerate(calendar.month_name) if name}
+
+# Month abbreviations indexed by month number (index 0 is empty)
+_MONTH_ABBR = tuple(calendar.month_abbr)
+
+@lru_cache(maxsize=32)
 def standardize_month_name(month_name):
     """Convert abbreviated month names to full month names"""
-    if month_name in MONTH_MAPPING:
-        return MONTH_MAPPING[month_name]
-    return month_name  # Return original if not in mapping
+    return MONTH_MAPPING.get(month_name, month_name)  # Return original if not in mapping
 
+@lru_cache(maxsize=32)
 def get_month_number(month_name):
     """Get the month number (1-12) from month name (handles abbreviations)"""
     standard_month = standardize_month_name(month_name)
+    if standard_month in _MONTH_TO_NUM:
+        return _MONTH_TO_NUM[standard_month]
+    # Fallback for any format issues - try to match flexibly
+    for full_month, i in _MONTH_TO_NUM.items():
+        if (standard_month.lower() in full_month.lower() or 
+                full_month.lower() in standard_month.lower()):
+            return i
+    # If still not found, return January as default
+    return 1
+
+def load_actual_hours(month_str):
+    """Load actual hours per user and project for a month, reusing a recent on-disk copy if present"""
+    file_prefix = f"hours_{month_str.replace(' ', '_')}_"
+    cache_file = CACHE_DIR / f"{file_prefix}{datetime.now():%Y%m%d}.parquet"
+    
+    if cache_file.exists() and time.time() - cache_file.stat().st_mtime < CACHE_TTL_SECONDS:
+        try:
+            # Keep the columns Arrow-backed to avoid a per-row conversion on load
+            return pd.read_parquet(cache_file, dtype_backend="pyarrow")
+        except Exception:
+            # Unreadable cache file - fall back to BigQuery
+            pass
+    
+    # Get data from BigQuery
+    report_df = bq.jira_tickets({"month": month_str})
+    
+    if report_df.empty or "time_spent" not in report_df.columns:
+        return pd.DataFrame()
+    
+    # Group by user and project, keeping only the columns needed for the sum
+    key_cols = ["teric_name", "teric_project_name"]
+    hours_df = report_df[key_cols + ["time_spent"]].astype({col: "category" for col in key_cols})
+    hours_df = hours_df.groupby(key_cols, observed=True)["time_spent"] \
+                       .sum() \
+                       .reset_index()
+    
+    # Convert seconds to hours (divide by 3600)
+    hours_df["actual_hours"] = (hours_df.pop("time_spent").astype("float64") / 3600.0).round(2)
+    
+    # Cache is best-effort; a failed write only means the next cold start queries again
+    tmp_path = None
     try:
-        return list(calendar.month_name).index(standard_month)
-    except ValueError:
-        # Fallback for any format issues - try to match flexibly
-        for i, full_month in enumerate(calendar.month_name):
-            if i > 0 and (standard_month.lower() in full_month.lower() or 
-                       full_month.lower() in standard_month.lower()):
-                return i
-        # If still not found, return January as default
-        return 1
+        CACHE_DIR.mkdir(exist_ok=True)
+        # Write to a temp file and move it into place so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=file_prefix, suffix=".tmp")
+        os.close(fd)
+        hours_df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_file)
+        tmp_path = None
+        # Remove stale copies of this month from previous days
+        for old_file in CACHE_DIR.glob(f"{file_prefix}*.parquet"):
+            if old_file != cache_file:
+                old_file.unlink(missing_ok=True)
+    except Exception:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    return hours_df
+
+@lru_cache(maxsize=32)
+def format_month_str(month, year):
+    """Format the BigQuery month key (e.g., "Mar 2025") for a month name and year"""
+    return f"{_MONTH_ABBR[get_month_number(month)]} {year}"
 
 @st.cache_data(ttl=3600)
 def fetch_all_actual_hours(month, year):
     """Fetch all actual hours data for the selected month/year"""
+    # Empty lookup returned when there is no data for the month
+    empty_lookup = pd.Series(
+        dtype=float,
+        name="actual_hours",
+        index=pd.MultiIndex.from_arrays([[], []], names=["teric_name", "teric_project_name"])
+    )
     try:
         # Format month string (e.g., "Mar 2025")
-        month_abbr = calendar.month_abbr[get_month_number(month)]
-        month_str = f"{month_abbr} {year}"
+        month_str = format_month_str(month, year)
         
-        # Get data from BigQuery
-        report_df = bq.jira_tickets({"month": month_str})
+        # Get hours per user and project (or today's on-disk copy)
+        hours_df = load_actual_hours(month_str)
         
-        if not report_df.empty and "time_spent" in report_df.columns:
-            # Convert seconds to hours (divide by 3600)
-            report_df["actual_hours"] = report_df["time_spent"].astype(float) / 3600.0
-            
-            # Group by user and project
-            grouped_df = report_df.groupby(["teric_name", "teric_project_name"])["actual_hours"] \
-                                .sum() \
-                                .round(2) \
-                                .reset_index()
-            
-            # Create lookup dictionary
-            return dict(zip(
-                zip(grouped_df["teric_name"], grouped_df["teric_project_name"]),
-                grouped_df["actual_hours"]
-            ))
+        if not hours_df.empty:
+            # Lookup Series indexed by (user, project)
+            key_cols = ["teric_name", "teric_project_name"]
+            hours_df[key_cols] = hours_df[key_cols].astype("category")
+            return hours_df.set_index(key_cols)["actual_hours"].astype("float64")
         
-        return {}
+        return empty_lookup
     except Exception as e:
         st.warning(f"Error fetching actual hours: {str(e)}")
-        return {}
+        return empty_lookup
     
 @st.cache_data(ttl=3600)
 def fetch_valid_users():
@@ -113,81 +192,134 @@ def fetch_valid_users():
     users_df = bq.get_users()
     return set(users_df["name"].unique()) if not users_df.empty else set()
 
-def process_allocation_csv(df, selected_month, selected_year):
+def read_allocation_csv(csv_file):
+    """Read an allocation CSV with Arrow's multithreaded parser, matching pd.read_csv defaults"""
+    try:
+        # pandas' NA tokens (N/A, null, #N/A, ...) still apply with the pyarrow engine
+        df = pd.read_csv(csv_file, engine='pyarrow', dtype_backend='pyarrow')
+    except pd.errors.ParserError:
+        # The pyarrow engine rejects short rows; the default parser pads them with NaN
+        csv_file.seek(0)
+        df = pd.read_csv(csv_file, dtype_backend='pyarrow')
+    
+    # The pyarrow engine keeps repeated headers as-is; rename them the way
+    # pandas' default parser does (e.g., SDI, SDI.1, SDI.2), skipping names in use
+    if df.columns.has_duplicates:
+        used = set(df.columns)
+        suffixes = {}
+        columns = []
+        for col in df.columns:
+            if col in suffixes:
+                new_col = col
+                while new_col in used:
+                    suffixes[col] += 1
+                    new_col = f"{col}.{suffixes[col]}"
+                used.add(new_col)
+                columns.append(new_col)
+            else:
+                suffixes[col] = 0
+                columns.append(col)
+        df.columns = columns
+    
+    return df
+
+def compute_completion_percentage(actual_hours, expected_hours):
+    """Completion percentage capped at 100, computed in place in a single output array"""
+    # Rows without positive expected hours are skipped and stay at 0
+    completion = np.zeros_like(expected_hours, dtype='float64')
+    has_expected = expected_hours > 0
+    np.multiply(actual_hours, 100.0, out=completion, where=has_expected)
+    np.divide(completion, expected_hours, out=completion, where=has_expected)
+    np.round(completion, 2, out=completion)
+    np.minimum(completion, 100, out=completion)
+    return completion
+
+def reshape_allocation_csv(df):
+    """Reshape the allocation CSV into one row per allocation plus one row per BigQuery project alias"""
+    # Remove ignored columns if they exist
+    df = df.drop(columns=IGNORED_COLUMNS, errors='ignore')
+    
+    # Store employee names as categories
+    df['Name'] = df['Name'].astype('category')
+    
+    # Convert numeric columns to float if they're Decimal
+    numeric_cols = [col for col in df.columns if col != 'Name']
+    df[numeric_cols] = df[numeric_cols].astype('float64')
+    
+    # Get all potential project columns (exclude Name column)
+    project_columns = [col for col in df.columns if col != 'Name']
+    
+    # Melt the wide CSV into one row per (employee, project column) allocation
+    long_df = df.melt(id_vars='Name', value_vars=project_columns,
+                      var_name='ProjectCol', value_name='Expected Hours')
+    long_df = long_df[long_df['Expected Hours'].notna() & (long_df['Expected Hours'] > 0)] \
+                     .reset_index(drop=True)
+    
+    # Standardize project names; unmapped columns keep their CSV name and
+    # combined columns are reported under their first alias
+    alias_df = long_df[['Name', 'ProjectCol']].reset_index() \
+                      .merge(PROJECT_MAPPING_DF, on='ProjectCol', how='left')
+    alias_df['standardized_project'] = alias_df['standardized_project'].fillna(alias_df['ProjectCol'])
+    long_df['Project'] = alias_df.groupby('index')['standardized_project'].first()
+    
+    return long_df[['Name', 'Project', 'Expected Hours']], alias_df[['index', 'Name', 'standardized_project']]
+
+@st.cache_data(ttl=3600)
+def load_allocation_csv(file_hash, _file_bytes):
+    """Read and reshape an uploaded allocation CSV, cached on the hash of its bytes"""
+    # Read the CSV file with Arrow's multithreaded parser
+    df = read_allocation_csv(io.BytesIO(_file_bytes))
+    return reshape_allocation_csv(df)
+
+def join_actual_hours(long_df, alias_df, selected_month, selected_year):
+    """Attach actual hours and completion percentage for the selected month/year to reshaped allocations"""
+    # Get users for validation and all actual hours from BigQuery (cached);
+    # the two queries are independent, so run them concurrently. Worker threads
+    # get the script context so cache hits and warnings still reach the app.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        users_future = executor.submit(fetch_valid_users)
+        hours_future = executor.submit(fetch_all_actual_hours, selected_month, selected_year)
+        valid_users = users_future.result()
+        actual_hours_lookup = hours_future.result()
+    
+    # Look up actual hours from our pre-fetched data
+    alias_df = alias_df.join(actual_hours_lookup, on=['Name', 'standardized_project'])
+    alias_df['actual_hours'] = alias_df['actual_hours'].fillna(0)
+    alias_df.loc[~alias_df['Name'].isin(valid_users), 'actual_hours'] = 0
+    
+    # Sum actual hours across the aliases of combined projects, round to 2 decimal places
+    actual_hours = alias_df.groupby('index')['actual_hours'].sum().round(2).to_numpy()
+    expected_hours = long_df['Expected Hours'].to_numpy()
+    
+    # Calculate completion percentage
+    completion_percentage = compute_completion_percentage(actual_hours, expected_hours)
+    
+    # Create DataFrame column-wise from the processed arrays
+    result_df = pd.DataFrame({
+        'Name': long_df['Name'].array,
+        'Project': long_df['Project'].to_numpy(),
+        'Expected Hours': expected_hours,
+        'Actual Hours': actual_hours,
+        'Completion %': completion_percentage
+    })
+    
+    # Name is already categorical from the reshaped CSV
+    result_df['Project'] = result_df['Project'].astype('category')
+    
+    # Sort by Name and Project
+    if not result_df.empty:
+        result_df = result_df.sort_values(['Name', 'Project'])
+    
+    return result_df
+
+def process_allocation_csv(file_hash, file_bytes, selected_month, selected_year):
     """Process the uploaded CSV and extract project allocations"""
     with st.spinner("Processing allocation data and fetching actual hours..."):
-        # Remove ignored columns if they exist
-        for col in IGNORED_COLUMNS:
-            if col in df.columns:
-                df = df.drop(columns=[col])
-        
-        # Convert numeric columns to float if they're Decimal
-        numeric_cols = [col for col in df.columns if col != 'Name']
-        for col in numeric_cols:
-            df[col] = df[col].astype(float)
-        
-        # Create an empty list to store the processed data
-        processed_data = []
-        
-        # Get all potential project columns (exclude Name column)
-        project_columns = [col for col in df.columns if col != 'Name']
-        
-        # Get users from BigQuery for validation (cached)
-        valid_users = fetch_valid_users()
-        
-        # Fetch all actual hours data in a single query (cached)
-        actual_hours_lookup = fetch_all_actual_hours(selected_month, selected_year)
-        
-        # Iterate through each row (employee)
-        for _, row in df.iterrows():
-            employee_name = row['Name']
-            
-            # Check each project column
-            for project_col in project_columns:
-                # If the employee has hours allocated for this project
-                if pd.notna(row[project_col]) and row[project_col] > 0:
-                    # Standardize project name using the mapping
-                    if project_col in PROJECT_NAME_MAPPING:
-                        if isinstance(PROJECT_NAME_MAPPING[project_col], list):
-                            standardized_project = PROJECT_NAME_MAPPING[project_col][0]
-                        else:
-                            standardized_project = PROJECT_NAME_MAPPING[project_col]
-                    else:
-                        standardized_project = project_col
-                    
-                    # Expected hours from the CSV
-                    expected_hours = float(row[project_col])
-                    
-                    # Look up actual hours from our pre-fetched data
-                    actual_hours = 0
-                    if employee_name in valid_users:
-                        user_project_key = (employee_name, standardized_project)
-                        actual_hours = actual_hours_lookup.get(user_project_key, 0)
-                        # Round to 2 decimal places
-                        actual_hours = round(actual_hours, 2)
-                    
-                    # Calculate completion percentage
-                    completion_percentage = 0
-                    if expected_hours > 0:
-                        completion_percentage = min(round((actual_hours / expected_hours) * 100, 2), 100)
-                    
-                    # Add to processed data
-                    processed_data.append({
-                        'Name': employee_name,
-                        'Project': standardized_project,
-                        'Expected Hours': expected_hours,
-                        'Actual Hours': actual_hours,
-                        'Completion %': completion_percentage
-                    })
-        
-        # Create DataFrame from the processed data
-        result_df = pd.DataFrame(processed_data)
-        
-        # Sort by Name and Project
-        if not result_df.empty:
-            result_df = result_df.sort_values(['Name', 'Project'])
-        
-        return result_df
+        # Reshaping depends only on the CSV bytes, so it is cached across
+        # month/year changes and across sessions uploading the same file
+        long_df, alias_df = load_allocation_csv(file_hash, file_bytes)
+        return join_actual_hours(long_df, alias_df, selected_month, selected_year)
 
 def main():
     st.title("Project Allocation Report")
@@ -201,18 +333,12 @@ def main():
         years_set = set()
         
         if not months_df.empty and "month" in months_df.columns:
-            for month_str in months_df["month"].unique():
-                try:
-                    parts = month_str.split()
-                    if len(parts) == 2:
-                        month_name = parts[0]
-                        year = parts[1]
-                        # Standardize month name for consistency
-                        standard_month = standardize_month_name(month_name)
-                        months_set.add(standard_month)
-                        years_set.add(year)
-                except Exception as e:
-                    st.warning(f"Issue processing month string '{month_str}': {str(e)}")
+            # Split every "Mon YYYY" string at once, keeping well-formed ones only
+            parts = months_df["month"].dropna().drop_duplicates().astype(str).str.split()
+            parts = parts[parts.str.len() == 2]
+            # Standardize month names for consistency
+            months_set = set(parts.str[0].map(standardize_month_name))
+            years_set = set(parts.str[1])
         
         # Convert sets to sorted lists
         months_list = sorted(list(months_set), key=get_month_number)
@@ -252,15 +378,17 @@ def main():
             try:
                 # Show progress indicator
                 with st.spinner("Reading CSV file..."):
-                    # Read the CSV file
-                    df = pd.read_csv(uploaded_file)
+                    # Hash the raw bytes so identical uploads share the cached processing
+                    file_bytes = uploaded_file.getvalue()
+                    file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
                 
                 # Process the CSV data with progress indicator
-                result_df = process_allocation_csv(df, selected_month, selected_year)
+                result_df = process_allocation_csv(file_hash, file_bytes, selected_month, selected_year)
                 
                 # Store the processed DataFrame in session state
                 st.session_state.allocation_df = result_df
-                st.session_state.raw_df = df
+                st.session_state.file_hash = file_hash
+                st.session_state.file_bytes = file_bytes
                 st.session_state.selected_month = selected_month
                 st.session_state.selected_year = selected_year
                 
@@ -277,7 +405,8 @@ def main():
         if selected_month != st.session_state.selected_month or selected_year != st.session_state.selected_year:
             # Re-process the data with the new month/year
             result_df = process_allocation_csv(
-                st.session_state.raw_df, 
+                st.session_state.file_hash,
+                st.session_state.file_bytes,
                 selected_month, 
                 selected_year
             )
@@ -304,9 +433,12 @@ def main():
             col2.metric("Total Actual Hours", f"{total_actual:.2f}")
             col3.metric("Overall Completion", f"{overall_completion}%")
             
-            # Add download button
-            csv_buffer = io.StringIO()
-            st.session_state.allocation_df.to_csv(csv_buffer, index=False)
+            # Add download button (CSV written by Arrow straight to bytes)
+            csv_buffer = io.BytesIO()
+            pacsv.write_csv(
+                pa.Table.from_pandas(st.session_state.allocation_df, preserve_index=False),
+                csv_buffer
+            )
             csv_data = csv_buffer.getvalue()
             
             st.download_button(
@@ -321,7 +453,7 @@ def main():
         # Option to reset and upload a new file
         if st.button("Upload a different allocation file"):
             # Clear the session state to allow uploading a new file
-            for key in ['allocation_df', 'raw_df', 'selected_month', 'selected_year']:
+            for key in ['allocation_df', 'file_hash', 'file_bytes', 'selected_month', 'selected_year']:
                 if key in st.session_state:
                     del st.session_state[key]
             st.rerun()